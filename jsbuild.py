@@ -17,18 +17,35 @@
 # limitations under the License.
 
 import argparse
+import base64
+import functools
 import hashlib
+import http.client
+import json
 import logging
 import os
 import re
+import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable, List, Tuple, Union
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 from urllib.parse import ParseResult as URL
-from urllib.parse import urljoin, urlparse, urlunparse
+from urllib.parse import unquote, urljoin, urlparse
 
 # TODO: Investigate support for multiple backends (like esbuild and uglify)
 # TODO: Investigate support for multiple languages (like TypeScript)
@@ -45,19 +62,50 @@ logger = logging.getLogger(NAME)
 
 
 def hash_buffer(buf: bytes) -> str:
-    inner = hashlib.sha256(b"jsbuild" + buf).digest()
-    outer = hashlib.sha256(b"jsbuild" + inner).digest()
-    return outer.hex()
+    # A single salted SHA-256 round is plenty for cache keys and file names.
+    # The salt and the buffer are fed separately to avoid copying `buf`.
+    h = hashlib.sha256(b"jsbuild")
+    h.update(buf)
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def hash_url(url: str) -> str:
+    # The same URL gets hashed for every import of it and every graph edge it
+    # is part of, so remember the results.
+    #
+    # These hashes only name cache files, build files and graph nodes, so 128
+    # bits are plenty and keep the names short.
+    return hash_buffer(url.encode("utf-8"))[:32]
 
 
 # Temp dir
-_TEMPDIR = tempfile.TemporaryDirectory(prefix="jsbuild-")
-TEMPDIR = Path(_TEMPDIR.name)
+
+# Only the build needs a temporary directory, so it is created on first use
+# instead of on every invocation. The directory object is kept alive by the
+# cache and removed when the process exits.
+
+
+@functools.lru_cache(maxsize=1)
+def _tempdir() -> tempfile.TemporaryDirectory:
+    tempdir = tempfile.TemporaryDirectory(prefix="jsbuild-")
+    logger.debug("Using temporary directory %s", tempdir.name)
+    return tempdir
+
+
+def get_tempdir() -> Path:
+    return Path(_tempdir().name)
+
 
 # File system cache
 
+# Like the temporary directory, the cache directory is only looked up and
+# created once something actually needs it. This keeps commands like --help
+# from touching the file system at all.
 
-def cache_dir():
+
+@functools.lru_cache(maxsize=1)
+def cache_dir() -> Path:
     # Let's figure out where to cache our files.
     cache = None
 
@@ -73,68 +121,193 @@ def cache_dir():
 
     # Create the directory if it doesn't exist.
     os.makedirs(path, exist_ok=True)
+    logger.debug("Caching files in %s.", path)
     return path
 
 
-CACHE_DIR = cache_dir()
-
-
+@functools.lru_cache(maxsize=None)
 def cache_path(key: str) -> Path:
-    key_utf8 = key.encode("utf-8")
-    return CACHE_DIR / hash_buffer(key_utf8)
+    return cache_dir() / hash_url(key)
 
 
 # HTTP
 
 USER_AGENT = f"{NAME}/{VERSION} (+https://www.gkbrk.com/project/{NAME})"
 
+# Connections are kept open and reused for later requests to the same host.
+# This saves a TCP (and TLS) handshake for every download after the first.
+# Imports are downloaded from multiple threads, so each thread keeps its own
+# connections.
+_HTTP_LOCAL = threading.local()
+
+
+@functools.lru_cache(maxsize=1)
+def http_proxies() -> Dict[str, str]:
+    # Same variables curl reads: http_proxy, https_proxy, no_proxy...
+    return urllib.request.getproxies()
+
+
+def http_proxy(parsed: URL) -> Optional[URL]:
+    """Return the proxy to use for `parsed`, if there is one."""
+    proxy = http_proxies().get(parsed.scheme)
+    if not proxy or urllib.request.proxy_bypass(parsed.hostname or ""):
+        return None
+    if "://" not in proxy:
+        proxy = f"http://{proxy}"
+    return parse_url(proxy)
+
+
+def basic_auth(parsed: URL) -> str:
+    user = unquote(parsed.username or "")
+    password = unquote(parsed.password or "")
+    token = base64.b64encode(f"{user}:{password}".encode("utf-8"))
+    return f"Basic {token.decode('ascii')}"
+
+
+def default_port(parsed: URL) -> int:
+    if parsed.port is not None:
+        return parsed.port
+    return 443 if parsed.scheme == "https" else 80
+
+
+def http_connection(parsed: URL) -> http.client.HTTPConnection:
+    connections = getattr(_HTTP_LOCAL, "connections", None)
+    if connections is None:
+        connections = _HTTP_LOCAL.connections = {}
+    key = (parsed.scheme, parsed.hostname or "", default_port(parsed))
+
+    if key not in connections:
+        proxy = http_proxy(parsed)
+        host, port = key[1], key[2]
+        if proxy is not None:
+            host, port = proxy.hostname or "", default_port(proxy)
+
+        if parsed.scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=60)
+            if proxy is not None:
+                # HTTPS goes through a CONNECT tunnel, TLS is still end to end.
+                tunnel_headers = {}
+                if proxy.username is not None:
+                    tunnel_headers["Proxy-Authorization"] = basic_auth(proxy)
+                conn.set_tunnel(key[1], key[2], headers=tunnel_headers)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=60)
+        connections[key] = conn
+    return connections[key]
+
+
+def http_download(url: str, path: Path):
+    """Download `url` into the file at `path`.
+
+    The body is streamed to disk rather than held in memory, and only moved
+    into place once it is complete. An interrupted download never leaves a
+    partial file that would later be mistaken for a cache hit.
+    """
+    parsed = parse_url(url)
+    target = parsed.path or "/"
+    if parsed.query:
+        target += f"?{parsed.query}"
+
+    conn = http_connection(parsed)
+    headers = {"User-Agent": USER_AGENT}
+    if parsed.username is not None:
+        headers["Authorization"] = basic_auth(parsed)
+
+    proxy = http_proxy(parsed)
+    if proxy is not None and parsed.scheme == "http":
+        # Plain HTTP proxies take the full URL, minus the credentials.
+        target = f"http://{parsed.netloc.rpartition('@')[2]}{target}"
+        if proxy.username is not None:
+            headers["Proxy-Authorization"] = basic_auth(proxy)
 
-def http_cache_or_download(url: str) -> str:
-    path = cache_path(f"http_{url}")
-
     try:
-        return path.read_bytes().decode("utf-8")
-    except Exception:
-        pass
+        conn.request("GET", target, headers=headers)
+        res = conn.getresponse()
+    except (http.client.HTTPException, OSError):
+        # The server might have dropped our idle connection. Closing it makes
+        # the next request open a fresh one.
+        conn.close()
+        conn.request("GET", target, headers=headers)
+        res = conn.getresponse()
+
+    if res.status != 200:
+        res.read()  # Drain the response so the connection can be reused.
+        raise Exception(f"HTTP {res.status} while downloading {url}")
+
+    # Every download gets its own partial file, so concurrent runs fetching
+    # the same URL can't write into each other's files.
+    fd, partial = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(res, f)
+        os.replace(partial, path)
+    except BaseException:
+        conn.close()
+        os.unlink(partial)
+        raise
+
+
+@functools.lru_cache(maxsize=256)
+def http_cache_or_download(url: str) -> Path:
+    """Return the path of the cached copy of `url`, downloading it first."""
+    path = cache_path(f"http_{url}")
 
-    logger.info("Downloading %s...", url)
-    subprocess.run(["curl", "--user-agent", USER_AGENT, "-o", path, "-s", url])
-    return path.read_bytes().decode("utf-8")
+    if not path.is_file():
+        logger.info("Downloading %s...", url)
+        http_download(url, path)
+    return path
 
 
 # File imports / import schemes
 
 # Importing based on different schemas (like file:// and http://) are handled
 # here.
+#
+# URLs are passed around as plain strings and only parsed here, when the
+# handler for their scheme is picked. Handlers get both forms.
+
+
+def read_file_file(url: str, parsed: URL) -> str:
+    return Path(parsed.path).read_text(encoding="utf-8")
 
 
-def read_file_file(url: URL) -> str:
-    p = Path(url.path)
-    return p.read_bytes().decode("utf-8")
+def read_file_http(url: str, parsed: URL) -> str:
+    path = http_cache_or_download(url)
+    return path.read_text(encoding="utf-8")
 
 
-def read_file_http(url: URL) -> str:
-    return http_cache_or_download(urlunparse(url))
+def read_file_https(url: str, parsed: URL) -> str:
+    return read_file_http(url, parsed)
 
 
-def read_file(url: URL) -> str:
-    logger.debug("Reading %s...", urlunparse(url))
-    scheme = url.scheme
+def read_file(url: str) -> str:
+    logger.debug("Reading %s...", url)
+    parsed = parse_url(url)
+    scheme = parsed.scheme
     handler_name = f"read_file_{scheme}"
 
     if handler_name not in globals():
         raise Exception(f"Unknown scheme: {scheme}")
 
     handler = globals()[handler_name]
-    return handler(url)
+    return handler(url, parsed)
 
 
 # Relative and absolute URLs
 
+# URLs are only ever parsed or joined through these helpers. The same URLs come
+# up again and again (every import is resolved once when scanning a file and
+# once when patching it), so both are memoized.
 
-def resolve_absolute(current: str, new: str) -> URL:
-    merged = urljoin(current, new)
-    return urlparse(merged)
+
+@functools.lru_cache(maxsize=None)
+def parse_url(url: str) -> URL:
+    return urlparse(url)
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_absolute(current: str, new: str) -> str:
+    return urljoin(current, new)
 
 
 # Closure compiler URL
@@ -143,22 +316,35 @@ VER = "v20231112"
 REPO = "https://repo1.maven.org/maven2"
 PROJECT = "com/google/javascript/closure-compiler"
 CLOSURE_URL = f"{REPO}/{PROJECT}/{VER}/closure-compiler-{VER}.jar"
-CLOSURE = cache_path(CLOSURE_URL)
 
 
-def java_check() -> bool:
+def closure_path() -> Path:
+    """Return where the Closure compiler jar is cached."""
+    return cache_path(CLOSURE_URL)
+
+
+@functools.lru_cache(maxsize=1)
+def java_installed() -> bool:
+    # Running `java -version` starts a whole JVM, so it is done at most once
+    # per process and shared by the build and the doctor.
     try:
         res = subprocess.run([ARGS.java, "-version"], capture_output=True)
-        assert res.returncode == 0
-        logger.debug("Java is installed.")
+    except OSError:
+        return False
 
-        for line in res.stderr.decode("utf-8").splitlines():
-            logger.debug("[java -version] %s", line.strip())
-        return True
-    except Exception:
+    for line in res.stderr.decode("utf-8").splitlines():
+        logger.debug("[java -version] %s", line.strip())
+    return res.returncode == 0
+
+
+def java_check() -> bool:
+    if not java_installed():
         logger.error("Java is not installed. Please install Java.")
         sys.exit(1)
 
+    logger.debug("Java is installed.")
+    return True
+
 
 def closure_compile(path: Path) -> str:
     """Compile a given file with the Closure compiler.
@@ -179,12 +365,37 @@ def closure_compile(path: Path) -> str:
 
     # Run the CLOSURE jar file
     params.append(ARGS.java)
+
+    # The JVM only lives for a single compilation, so stop at the quick C1
+    # tier instead of spending start-up time on the optimizing compiler.
+    params.append("-XX:TieredStopAtLevel=1")
+
+    # Closure recurses deeply over large inputs, give it room on the stack.
+    params.append("-Xss16m")
+
+    # A single compilation is a batch job, use the throughput collector.
+    params.append("-XX:+UseParallelGC")
+
+    # Most of the JVM start-up time goes into loading the compiler's classes.
+    # With a class data sharing archive, the JVM dumps them to the cache
+    # directory on the first run and maps them straight into memory later on.
+    # This needs JDK 19 or newer, so it is opt-in.
+    if ARGS.closure_cds:
+        archive = cache_path(f"cds_{CLOSURE_URL}")
+        params.append("-XX:+AutoCreateSharedArchive")
+        params.append(f"-XX:SharedArchiveFile={archive}")
+
+    # User supplied options come last so that they override the ones above.
+    params.extend(shlex.split(ARGS.java_opts))
+
     params.append("-jar")
-    params.append(CLOSURE)
+    params.append(closure_path())
 
-    # Include the imports directory
-    params.append("--js")
-    params.append("imports/*.js")
+    # Include the imports directory. The files are listed here rather than
+    # passed as a glob, so the compiler does not have to expand it itself.
+    for imp in sorted((Path(path) / "imports").glob("*.js")):
+        params.append("--js")
+        params.append(f"imports/{imp.name}")
 
     # Optimization parameters
     params.append("-W")
@@ -197,11 +408,10 @@ def closure_compile(path: Path) -> str:
     params.append("--dependency_mode")
     params.append("PRUNE")
 
-    # Output
+    # Output. Without --js_output_file the compiled code is written to stdout,
+    # which saves writing it to disk only to read it back.
     params.append("--language_out")
     params.append(ARGS.language_out)
-    params.append("--js_output_file")
-    params.append("output.js")
 
     # Entry point
     params.append("--js")
@@ -211,40 +421,161 @@ def closure_compile(path: Path) -> str:
 
     proc = subprocess.run(params, cwd=path, capture_output=True)
 
+    if proc.returncode != 0:
+        for err_line in proc.stderr.decode("utf-8").splitlines():
+            logger.error("[closure] %s", err_line.strip())
+        logger.error("Closure Compiler exited with code %d.", proc.returncode)
+        sys.exit(1)
+
     for err_line in proc.stderr.decode("utf-8").splitlines():
         logger.warning("[closure] %s", err_line.strip())
-    return (Path(path) / "output.js").read_text().strip()
+    return proc.stdout.decode("utf-8").strip()
 
 
 # Deps
 
+# Number of files to fetch and parse at the same time.
+MAX_WORKERS = 16
+
+
+@functools.lru_cache(maxsize=1)
+def _executor() -> ThreadPoolExecutor:
+    # One pool is shared by every walk in the process. Its threads outlive a
+    # single walk, and so do the HTTP connections each of them keeps open.
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# Matches every import statement of a file in a single scan over its contents.
+# The module path can be in single or double quotes, and trailing whitespace
+# after the semicolon is ignored.
+_IMPORT_RE = re.compile(
+    r"""^import (.*?) from (["'])(.*?)\2;[ \t]*$""", re.MULTILINE
+)
+
+
+@functools.lru_cache(maxsize=None)
+def load_module(url: str) -> Tuple[str, Tuple[str, ...]]:
+    """Return the contents of `url` and the URLs it imports directly.
 
-def import_statements_recursive(url: URL) -> Iterable[Tuple[URL, URL]]:
+    Results are memoized, so every file is read and scanned only once per
+    process no matter how many times it is walked or built.
+    """
     content = read_file(url)
 
-    for line in content.split("\n"):
-        # TODO: Accept single-quotes as well
-        m = re.match('^import .*? from "(.*?)";$', line)
-        if m:
-            new_url = resolve_absolute(urlunparse(url), m.group(1))
-            yield url, new_url
-            yield from import_statements_recursive(new_url)
-
-
-def patch_import_statement(
-    line: str, current_path: str, inside_import: bool = False
-):
-    # TODO: Accept single-quotes as well
-    m = re.match('^import (.*?) from "(.*?)";$', line)
-    if m:
-        url = m.group(2)
-        url = resolve_absolute(current_path, url)
-        url = str(url).encode("utf-8")
-        h = hash_buffer(url)
-        if inside_import:
-            return f'import {m.group(1)} from "./{h}.js";'
-        return f'import {m.group(1)} from "./imports/{h}.js";'
-    return line
+    imports = tuple(
+        resolve_absolute(url, m.group(3)) for m in _IMPORT_RE.finditer(content)
+    )
+    return content, imports
+
+
+# The imports of local files are also cached on disk, one entry per file.
+# Next to the imports, an entry records the modification time and size the
+# file had when it was scanned. Walking the imports of files that did not
+# change since the last run then needs neither reading nor scanning them.
+# Only list-deps and dependency-dag use this cache, the build needs the
+# contents of every file anyway.
+#
+# Bump DEPS_CACHE_VERSION whenever the way imports are found or resolved
+# changes (for example `_IMPORT_RE`), so that stale import lists are ignored.
+DEPS_CACHE_VERSION = 1
+
+
+def deps_cache_path(url: str) -> Path:
+    return cache_path(f"deps_{VERSION}:{DEPS_CACHE_VERSION}:{url}")
+
+
+def file_stamp(url: str) -> Optional[Dict[str, int]]:
+    """Return the modification time and size of a local file."""
+    parsed = parse_url(url)
+    if parsed.scheme != "file":
+        return None
+
+    try:
+        st = os.stat(parsed.path)
+    except OSError:
+        return None
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+@functools.lru_cache(maxsize=None)
+def module_imports(url: str) -> Tuple[str, ...]:
+    """Return the URLs directly imported by the file at `url`."""
+    # The file is stat'ed before it is read. If it changes in between, the
+    # entry records the older stamp and is simply refreshed on the next run.
+    stamp = file_stamp(url)
+    if stamp is None:
+        return load_module(url)[1]
+
+    path = deps_cache_path(url)
+    if path.is_file():
+        try:
+            cached = json.loads(path.read_text(encoding="utf-8"))
+        except ValueError:
+            cached = None
+
+        # Skip entries for an older version of the file, as well as damaged
+        # ones. Either way the file is parsed again and the entry rewritten.
+        if isinstance(cached, dict):
+            imports = cached.get("imports")
+            fresh = all(cached.get(k) == v for k, v in stamp.items())
+            if fresh and isinstance(imports, list):
+                if all(isinstance(u, str) for u in imports):
+                    return tuple(imports)
+
+    imports = load_module(url)[1]
+    entry = {**stamp, "imports": imports}
+    path.write_text(json.dumps(entry), encoding="utf-8")
+    return imports
+
+
+def _loaded_imports(url: str) -> Tuple[str, ...]:
+    return load_module(url)[1]
+
+
+def import_statements_recursive(
+    url: str, use_deps_cache: bool = True
+) -> Iterable[Tuple[str, str]]:
+    # Walk the import graph breadth-first, visiting every file only once.
+    # Shared dependencies would otherwise be read and parsed once per path to
+    # them.
+    #
+    # The files of each layer are independent of each other, so they are
+    # fetched and parsed concurrently. For imports over HTTP this means waiting
+    # for the slowest download of a layer instead of the sum of all of them.
+    #
+    # Callers that need the contents of every module pass `use_deps_cache` as
+    # False. The modules are then loaded during the walk itself, instead of
+    # reading the on-disk import lists first and each file again afterwards.
+    get_imports = module_imports if use_deps_cache else _loaded_imports
+    seen = {url}
+    layer = [url]
+
+    executor = _executor()
+    while layer:
+        next_layer = []
+
+        for current, imports in zip(layer, executor.map(get_imports, layer)):
+            for new_url in imports:
+                yield current, new_url
+
+                if new_url not in seen:
+                    seen.add(new_url)
+                    next_layer.append(new_url)
+
+        layer = next_layer
+
+
+def patch_import_statements(
+    content: str, current_path: str, inside_import: bool = False
+) -> str:
+    """Point the imports in `content` to their copies in the build dir."""
+    prefix = "./" if inside_import else "./imports/"
+
+    def patch(m: re.Match) -> str:
+        url = resolve_absolute(current_path, m.group(3))
+        h = hash_url(url)
+        return f'import {m.group(1)} from "{prefix}{h}.js";'
+
+    return _IMPORT_RE.sub(patch, content)
 
 
 # Actions / commands
@@ -263,16 +594,12 @@ def action_list_deps():
 
     Note that the output of this command includes the dependencies recursively.
     """
-    path = Path(ARGS.file)
-
+    base_url = f"file://{Path(ARGS.file).resolve()}"
     printed: set[str] = set()
 
-    absolute = f"file://{path.resolve().absolute()}"
-
-    for _, s in import_statements_recursive(urlparse(absolute)):
-        s = urlunparse(s)
+    for _, s in import_statements_recursive(base_url):
         if s not in printed:
-            print(hash_buffer(s.encode("utf-8")), s)
+            print(hash_url(s), s)
         printed.add(s)
 
 
@@ -288,26 +615,34 @@ def action_dependency_dag():
     """
     url = f"file://{Path(ARGS.file).resolve()}"
 
-    dot_file = ""
-    nodes: set[str] = set()
+    # The graph is collected as a list of lines and joined at the end, as
+    # repeatedly appending to one string is quadratic in the output size.
+    lines: List[str] = []
 
-    dot_file += "digraph {\n"
-    dot_file += "graph [splines=true overlap=false];\n"
+    lines.append("digraph {\n")
+    lines.append("graph [splines=true overlap=false];\n")
 
-    for src, target in import_statements_recursive(urlparse(url)):
-        _src = str(urlunparse(src))
-        _target = str(urlunparse(target))
+    # A file that imports the same module more than once yields the same edge
+    # repeatedly, so the edges and nodes are deduplicated. Dicts are used
+    # rather than sets to keep them in walk order, which keeps the layout the
+    # same from one run to the next.
+    edges: Dict[Tuple[str, str], None] = {}
+    nodes: Dict[str, None] = {}
 
-        _h_src = hash_buffer(_src.encode("utf-8"))
-        _h_target = hash_buffer(_target.encode("utf-8"))
+    for src, target in import_statements_recursive(url):
+        edges[(src, target)] = None
 
-        dot_file += f'"{_h_target}" -> "{_h_src}"\n'
+        nodes[src] = None
+        nodes[target] = None
 
-        nodes.add(_src)
-        nodes.add(_target)
+    # Every node appears in many edges, so hash each of them only once.
+    node_hash = {n: hash_url(n) for n in nodes}
+
+    for src, target in edges:
+        lines.append(f'"{node_hash[target]}" -> "{node_hash[src]}"\n')
 
     for n in nodes:
-        h = hash_buffer(n.encode("utf-8"))
+        h = node_hash[n]
         shape = "box"
 
         # Mark imports fetched over HTTP in a different way
@@ -321,10 +656,10 @@ def action_dependency_dag():
             attr += " color = red"
 
         attr += "];\n"
-        dot_file += attr
+        lines.append(attr)
 
-    dot_file += "}\n"
-    dot_file = dot_file.encode("utf-8")
+    lines.append("}\n")
+    dot_file = "".join(lines).encode("utf-8")
 
     proc = subprocess.run(
         ["sfdp", "-Tpng", "-o/dev/stdout"], input=dot_file, capture_output=True
@@ -338,44 +673,37 @@ def action_dependency_dag():
 
 def action_ensure_closure():
     """Download or update the Closure compiler."""
-    subprocess.run(["curl", "-o", cache_path(CLOSURE_URL), CLOSURE_URL])
+    logger.info("Downloading %s...", CLOSURE_URL)
+    http_download(CLOSURE_URL, closure_path())
 
 
 def action_build():
     """Fetch all the dependencies of the input file and build it."""
-    path = Path(ARGS.file).resolve()
-
-    with (TEMPDIR / "main.js").open("w+") as main_file:
-        with path.open("r") as f:
-            for line in f:
-                main_file.write(
-                    patch_import_statement(line, f"file://{path}") + "\n"
-                )
-
-    os.makedirs(TEMPDIR / "imports")
-    imports: set[URL] = set()
-
-    for _, url in import_statements_recursive(
-        urlparse(f"file://{path.resolve()}")
-    ):
-        imports.add(url)
-
-    for imp in imports:
-        url = str(imp).encode("utf-8")
-        h = hash_buffer(url)
-        content = read_file(imp)
-
-        with (TEMPDIR / "imports" / f"{h}.js").open("w+") as js_file:
-            for line in content.split("\n"):
-                js_file.write(
-                    patch_import_statement(line, urlunparse(imp), True) + "\n"
-                )
+    base_url = f"file://{Path(ARGS.file).resolve()}"
+    tempdir = get_tempdir()
+
+    os.makedirs(tempdir / "imports")
+
+    # Finish the walk before writing anything. The walk loads every layer of
+    # the graph concurrently, while loading a module here would download it on
+    # this thread, one import at a time. Afterwards every module is already
+    # loaded and memoized, so writing them does not read any file again.
+    walk = import_statements_recursive(base_url, use_deps_cache=False)
+    imports = {url for _, url in walk}
+
+    for url in imports:
+        h = hash_url(url)
+        content = patch_import_statements(load_module(url)[0], url, True)
+        (tempdir / "imports" / f"{h}.js").write_text(content, encoding="utf-8")
+
+    main_js = patch_import_statements(load_module(base_url)[0], base_url)
+    (tempdir / "main.js").write_text(main_js, encoding="utf-8")
 
     # Check if we have the closure compiler
-    if not CLOSURE.is_file():
+    if not closure_path().is_file():
         action_ensure_closure()
 
-    output = closure_compile(TEMPDIR)
+    output = closure_compile(tempdir)
 
     if ARGS.output:
         output_path = Path(ARGS.output).resolve()
@@ -389,14 +717,30 @@ def action_nuke_cache():
     print("Deleting cached files...")
 
     # Do not remove the cache directory itself, just its contents.
-    for f in CACHE_DIR.iterdir():
-        print(f"  {f}")
-        f.unlink()
+    deleted = []
+    with os.scandir(cache_dir()) as entries:
+        for entry in entries:
+            os.unlink(entry.path)
+            deleted.append(f"  {entry.path}\n")
+
+    print("".join(deleted), end="")
     print("Done.")
 
 
 # Doctor checks
 
+# Each check is a function named `doctor_check_name_of_check`, registered with
+# the `doctor_check` decorator. The doctor runs them in the order they are
+# defined.
+
+DOCTOR_CHECKS: List[Tuple[str, Callable[[], Optional[bool]]]] = []
+
+
+def doctor_check(fn: Callable[[], Optional[bool]]):
+    pretty_name = fn.__name__[13:].replace("_", " ").capitalize()
+    DOCTOR_CHECKS.append((pretty_name, fn))
+    return fn
+
 
 def try_run(*cmd: str) -> bool:
     try:
@@ -406,28 +750,41 @@ def try_run(*cmd: str) -> bool:
         return False
 
 
+@doctor_check
 def doctor_check_java():
-    return try_run(ARGS.java, "-version")
-
-
-def doctor_check_curl():
-    return try_run("curl", "--version")
+    return java_installed()
 
 
+@doctor_check
 def doctor_check_graphviz():
     return try_run("dot", "-V")
 
 
+@doctor_check
 def doctor_check_feh():
     return try_run("feh", "--version")
 
 
+@doctor_check
 def doctor_check_closure_file():
-    return CLOSURE.is_file()
+    return closure_path().is_file()
 
 
+@doctor_check
 def doctor_check_closure_version():
-    return try_run(ARGS.java, "-jar", str(CLOSURE), "--version")
+    return try_run(ARGS.java, "-jar", str(closure_path()), "--version")
+
+
+def run_doctor_check(fn: Callable[[], Optional[bool]]):
+    """Run a doctor check, returning its result, error and duration."""
+    start_time = time.monotonic()
+    result, error = None, None
+    try:
+        result = fn()
+    except Exception as e:
+        error = e
+    end_time = time.monotonic()
+    return result, error, end_time - start_time
 
 
 def action_doctor():
@@ -440,32 +797,32 @@ def action_doctor():
     print("and report the output to the issue tracker.")
     print("")
 
-    for name in globals():
-        if name.startswith("doctor_check_"):
-            fn = globals()[name]
-            pretty_name = name[13:].replace("_", " ").capitalize()
-            print(f"Checking {pretty_name}...", end=" ")
+    # Most checks spend their time waiting on a subprocess (starting a JVM
+    # alone takes a while), so they all run at once. Results are still
+    # printed in the order the checks are defined.
+    with ThreadPoolExecutor(max_workers=len(DOCTOR_CHECKS)) as executor:
+        futures = [
+            (pretty_name, fn, executor.submit(run_doctor_check, fn))
+            for pretty_name, fn in DOCTOR_CHECKS
+        ]
 
-            start_time = time.monotonic()
-            try:
-                result = fn()
+        for pretty_name, fn, future in futures:
+            print(f"Checking {pretty_name}...", end=" ", flush=True)
+            result, error, duration = future.result()
 
-                if result is None:
-                    print("Unknown")
-                elif result:
-                    print("OK")
-                else:
-                    print("Failed")
-            except Exception as e:
+            if error is not None:
                 if ARGS.verbose:
                     print("ERROR")
-                    print(f"Exception: {e}")
+                    print(f"Exception: {error}")
                 else:
                     print("ERROR (run with --verbose for more info)")
-            end_time = time.monotonic()
-            logger.debug(
-                "Check %s took %s seconds", name, end_time - start_time
-            )
+            elif result is None:
+                print("Unknown")
+            elif result:
+                print("OK")
+            else:
+                print("Failed")
+            logger.debug("Check %s took %s seconds", fn.__name__, duration)
 
 
 # Command-line arguments
@@ -480,6 +837,13 @@ parser.add_argument(
     default="java",
     help="Path to the Java binary. Defaults to `java`.",
 )
+parser.add_argument(
+    "--java_opts",
+    default="",
+    help="Extra options to pass to the JVM running the Closure compiler. "
+    "As they start with a dash, give them with an equals sign, for example "
+    '`--java_opts="-Xmx2g -Xss32m"`.',
+)
 
 subparsers = parser.add_subparsers(dest="command", required=True)
 
@@ -512,6 +876,12 @@ sp.add_argument("--output", help="The output file", nargs="?")
 sp.add_argument(
     "--language_out", help="The language to use", default="ECMASCRIPT_2019"
 )
+sp.add_argument(
+    "--closure_cds",
+    action="store_true",
+    help="Cache the Closure compiler classes to speed up JVM start-up. "
+    "Requires JDK 19 or newer.",
+)
 
 # [action] nuke-cache
 sp = subparsers.add_parser(
@@ -530,8 +900,6 @@ if ARGS.verbose:
     logger.setLevel(logging.DEBUG)
 
 logger.debug("Welcome to %s v%s!", NAME, VERSION)
-logger.debug("Caching files in %s.", CACHE_DIR)
-logger.debug("Using temporary directory %s", TEMPDIR)
 
 
 def main():